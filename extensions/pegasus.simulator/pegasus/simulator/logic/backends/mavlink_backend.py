@@ -8,6 +8,8 @@ __all__ = ["MavlinkBackend", "MavlinkBackendConfig"]
 
 import carb
 import time
+import atexit
+import struct
 import numpy as np
 from pymavlink import mavutil
 
@@ -35,52 +37,93 @@ class SensorSource:
     DIFF_PRESS: int = 1024
 
 
+class SensorField:
+    """ The indexes of each simulated sensor value inside the SensorMsg.data buffer. The values are stored
+    in the same order as the fields of the mavlink HIL_SENSOR message
+
+    Atribute:
+        | ACC (slice): the x, y and z accelerometer values (m/s^2)
+        | GYRO (slice): the x, y and z gyroscope values (rad/s)
+        | MAG (slice): the x, y and z magnetometer values (gauss)
+        | ABS_PRESSURE (int): the absolute pressure (hPa)
+        | DIFF_PRESSURE (int): the differential pressure (hPa)
+        | PRESSURE_ALT (int): the altitude computed from the pressure (m)
+        | TEMPERATURE (int): the temperature (degC)
+        | NUM_FIELDS (int): the total number of values in the buffer
+    """
+
+    ACC: slice = slice(0, 3)
+    GYRO: slice = slice(3, 6)
+    MAG: slice = slice(6, 9)
+    ABS_PRESSURE: int = 9
+    DIFF_PRESSURE: int = 10
+    PRESSURE_ALT: int = 11
+    TEMPERATURE: int = 12
+    NUM_FIELDS: int = 13
+
+
+class GPSField:
+    """ The indexes of each simulated GPS value inside the SensorMsg.gps_data buffer. The values are stored
+    in the same order as the fields of the mavlink HIL_GPS message, already converted to integers
+
+    Atribute:
+        | LATITUDE (int): the latitude (degE7)
+        | LONGITUDE (int): the longitude (degE7)
+        | ALTITUDE (int): the altitude (mm)
+        | EPH (int): the horizontal dilution of position
+        | EPV (int): the vertical dilution of position
+        | VELOCITY (int): the ground speed (cm/s)
+        | VELOCITY_NORTH (int): the velocity in the north direction (cm/s)
+        | VELOCITY_EAST (int): the velocity in the east direction (cm/s)
+        | VELOCITY_DOWN (int): the velocity in the down direction (cm/s)
+        | COG (int): the course over ground (cdeg)
+        | NUM_FIELDS (int): the total number of values in the buffer
+    """
+
+    LATITUDE: int = 0
+    LONGITUDE: int = 1
+    ALTITUDE: int = 2
+    EPH: int = 3
+    EPV: int = 4
+    VELOCITY: int = 5
+    VELOCITY_NORTH: int = 6
+    VELOCITY_EAST: int = 7
+    VELOCITY_DOWN: int = 8
+    COG: int = 9
+    NUM_FIELDS: int = 10
+
+
 class SensorMsg:
     """
     An auxiliary data class where we write all the sensor data that is going to be sent through mavlink
+
+    Atribute:
+        | NEW_IMU (int): bit of new_data that signals new IMU data
+        | NEW_MAG (int): bit of new_data that signals new magnetometer data
+        | NEW_BARO (int): bit of new_data that signals new barometer data
+        | NEW_PRESS (int): bit of new_data that signals new diff pressure data
     """
 
+    NEW_IMU: int = 1
+    NEW_MAG: int = 2
+    NEW_BARO: int = 4
+    NEW_PRESS: int = 8
+
     def __init__(self):
 
+        # IMU, Baro, Magnetometer and Airspeed data, stored contiguously in a single buffer indexed by SensorField
+        self.data: np.ndarray = np.zeros((SensorField.NUM_FIELDS,), dtype=np.float32)
+
+        # Bitmap with the NEW_* bits of the sensors that produced new data since the last HIL_SENSOR message
+        self.new_data: int = 0
+
         # IMU Data
-        self.new_imu_data: bool = False
         self.received_first_imu: bool = False
-        self.xacc: float = 0.0
-        self.yacc: float = 0.0
-        self.zacc: float = 0.0
-        self.xgyro: float = 0.0
-        self.ygyro: float = 0.0
-        self.zgyro: float = 0.0
-
-        # Baro Data
-        self.new_bar_data: bool = False
-        self.abs_pressure: float = 0.0
-        self.pressure_alt: float = 0.0
-        self.temperature: float = 0.0
-
-        # Magnetometer Data
-        self.new_mag_data: bool = False
-        self.xmag: float = 0.0
-        self.ymag: float = 0.0
-        self.zmag: float = 0.0
-
-        # Airspeed Data
-        self.new_press_data: bool = False
-        self.diff_pressure: float = 0.0
-
-        # GPS Data
+
+        # GPS Data, where the values sent in the HIL_GPS message are stored in a single buffer indexed by GPSField
         self.new_gps_data: bool = False
         self.fix_type: int = 0
-        self.latitude_deg: float = -999
-        self.longitude_deg: float = -999
-        self.altitude: float = -999
-        self.eph: float = 1.0
-        self.epv: float = 1.0
-        self.velocity: float = 0.0
-        self.velocity_north: float = 0.0
-        self.velocity_east: float = 0.0
-        self.velocity_down: float = 0.0
-        self.cog: float = 0.0
+        self.gps_data: np.ndarray = np.array([-999, -999, -999, 1, 1, 0, 0, 0, 0, 0], dtype=np.int64)
         self.satellites_visible: int = 0
 
         # Vision Pose
@@ -95,15 +138,39 @@ class SensorMsg:
 
         # Simulation State
         self.new_sim_state: bool = False
-        self.sim_attitude = [1.0, 0.0, 0.0, 0.0]  # [w, x, y, z]
-        self.sim_acceleration = [0.0, 0.0, 0.0]  # [x,y,z body acceleration]
-        self.sim_angular_vel = [0.0, 0.0, 0.0]  # [roll-rate, pitch-rate, yaw-rate] rad/s
+        self.sim_attitude = np.array([1.0, 0.0, 0.0, 0.0])  # [w, x, y, z]
+        self.sim_acceleration = np.zeros((3,), dtype=np.int64)  # [x,y,z body acceleration]
+        self.sim_angular_vel = np.zeros((3,))  # [roll-rate, pitch-rate, yaw-rate] rad/s
         self.sim_lat = 0.0  # [deg]
         self.sim_lon = 0.0  # [deg]
         self.sim_alt = 0.0  # [m]
         self.sim_ind_airspeed = 0.0  # Indicated air speed
         self.sim_true_airspeed = 0.0  # Indicated air speed
-        self.sim_velocity_inertial = [0.0, 0.0, 0.0]  # North-east-down [m/s]
+        self.sim_velocity_inertial = np.zeros((3,), dtype=np.int64)  # North-east-down [m/s]
+
+
+# Lookup table that maps every combination of the SensorMsg.NEW_* bits to the mavlink fields_updated bitmask
+_FIELDS_UPDATED_LUT = tuple(
+    (SensorSource.ACCEL | SensorSource.GYRO if new_data & SensorMsg.NEW_IMU else 0)
+    | (SensorSource.MAG if new_data & SensorMsg.NEW_MAG else 0)
+    | (SensorSource.BARO if new_data & SensorMsg.NEW_BARO else 0)
+    | (SensorSource.DIFF_PRESS if new_data & SensorMsg.NEW_PRESS else 0)
+    for new_data in range(16)
+)
+
+# Scale factors that convert the GPS data (latitude, longitude, altitude, eph, epv, speed, velocity north, east and
+# down, cog and the groundtruth latitude, longitude and altitude) to the integer units used by mavlink
+_GPS_SCALE = np.array([1e7, 1e7, 1e3, 1.0, 1.0, 100.0, 100.0, 100.0, 100.0, 100.0, 1e7, 1e7, 1e3])
+
+
+# Compiled structs used to serialize the HIL_SENSOR mavlink 2 frames (header, payload and checksum). The payload
+# does not include the 'id' extension field, since it is always 0 and trailing zeros are truncated in mavlink 2
+_HIL_SENSOR_HEADER_STRUCT = struct.Struct("<BBBBBBBHB")
+_HIL_SENSOR_PAYLOAD_STRUCT = struct.Struct("<Q13fI")
+_CRC_STRUCT = struct.Struct("<H")
+
+# Period between the hearbeats sent through mavlink (1Hz), in nanoseconds
+_HEARTBEAT_PERIOD_NS = 1000000000
 
 
 class ThrusterControl:
@@ -203,6 +270,7 @@ class MavlinkBackendConfig:
             >>>  "px4_dir": "PegasusInterface().px4_path",
             >>>  "px4_vehicle_model": "iris",
             >>>  "enable_lockstep": True,
+            >>>  "lockstep_timeout": 1.0,
             >>>  "num_rotors": 4,
             >>>  "input_offset": [0.0, 0.0, 0.0, 0.0],
             >>>  "input_scaling": [1000.0, 1000.0, 1000.0, 1000.0],
@@ -224,6 +292,7 @@ class MavlinkBackendConfig:
 
         # Configurations to interpret the rotors control messages coming from mavlink
         self.enable_lockstep: bool = config.get("enable_lockstep", True)
+        self.lockstep_timeout: float = config.get("lockstep_timeout", 1.0)  # [s]
         self.num_rotors: int = config.get("num_rotors", 4)
         self.input_offset = config.get("input_offset", [0.0, 0.0, 0.0, 0.0])
         self.input_scaling = config.get("input_scaling", [1000.0, 1000.0, 1000.0, 1000.0])
@@ -253,6 +322,17 @@ class MavlinkBackend(Backend):
         # The connection will only be created once the simulation starts
         self._vehicle_id = config.vehicle_id
         self._connection = None
+
+        # Bound methods of the mavlink connection that are called at every update (cached once the connection is
+        # created, to avoid resolving them again at every call)
+        self._recv_match = None
+        self._heartbeat_encode = None
+        self._hil_sensor_encode = None
+        self._hil_gps_encode = None
+
+        # Buffer with the mavlink frames queued during an update, which are all written to the connection at once
+        self._tx_buffer: bytearray = bytearray()
+
         self._connection_port = (
             config.connection_type
             + ":"
@@ -281,17 +361,12 @@ class MavlinkBackend(Backend):
             config.num_rotors, config.input_offset, config.input_scaling, config.zero_position_armed
         )
 
-        # Vehicle actuator control data
-        self._num_inputs: int = config.num_rotors
-        self._input_reference: np.ndarray = np.zeros((self._num_inputs,))
-        self._armed: bool = False
-
-        self._input_offset: np.ndarray = np.zeros((self._num_inputs,))
-        self._input_scaling: np.ndarray = np.zeros((self._num_inputs,))
-
         # Select whether lockstep is enabled
         self._enable_lockstep: bool = config.enable_lockstep
 
+        # Maximum time to wait for the actuator control data in lockstep, before assuming that PX4 stopped responding
+        self._lockstep_timeout: float = config.lockstep_timeout
+
         # Auxiliar variables to handle the lockstep between receiving sensor data and actuator control
         self._received_first_actuator: bool = False
 
@@ -300,7 +375,11 @@ class MavlinkBackend(Backend):
         # Auxiliar variables to check if we have already received an hearbeat from the software in the loop simulation
         self._received_first_hearbeat: bool = False
 
-        self._last_heartbeat_sent_time = 0
+        # Precomputed HIL_SENSOR mavlink 2 header (only available after the first hearbeat is received)
+        self._hil_sensor_header: bytes = None
+        self._hil_sensor_crc_extra: bytes = None
+
+        self._next_heartbeat_time_ns: int = 0
 
         # Auxiliar variables for setting the u_time when sending sensor data to px4
         self._current_utime: int = 0
@@ -332,21 +411,16 @@ class MavlinkBackend(Backend):
         """Gets called by the 'update_sensor' method to update the current IMU data
 
         Args:
-            data (dict): The data produced by an IMU sensor
+            data (dict): The data produced by an IMU sensor, where the linear acceleration and angular velocity are
+                numpy arrays that get copied (each with a single slice copy) to the sensor buffer
         """
 
-        # Acelerometer data
-        self._sensor_data.xacc = data["linear_acceleration"][0]
-        self._sensor_data.yacc = data["linear_acceleration"][1]
-        self._sensor_data.zacc = data["linear_acceleration"][2]
-
-        # Gyro data
-        self._sensor_data.xgyro = data["angular_velocity"][0]
-        self._sensor_data.ygyro = data["angular_velocity"][1]
-        self._sensor_data.zgyro = data["angular_velocity"][2]
+        # Acelerometer and gyro data
+        self._sensor_data.data[SensorField.ACC] = data["linear_acceleration"]
+        self._sensor_data.data[SensorField.GYRO] = data["angular_velocity"]
 
         # Signal that we have new IMU data
-        self._sensor_data.new_imu_data = True
+        self._sensor_data.new_data |= SensorMsg.NEW_IMU
         self._sensor_data.received_first_imu = True
 
     def update_gps_data(self, data):
@@ -356,28 +430,39 @@ class MavlinkBackend(Backend):
             data (dict): The data produced by an GPS sensor
         """
 
-        # GPS data
+        # Convert the GPS data (and the groundtruth for the latitude, longitude and altitude) to integers all at once
+        gps_data = np.array(
+            [
+                data["latitude"],
+                data["longitude"],
+                data["altitude"],
+                data["eph"],
+                data["epv"],
+                data["speed"],
+                data["velocity_north"],
+                data["velocity_east"],
+                data["velocity_down"],
+                data["cog"],
+                data["latitude_gt"],
+                data["longitude_gt"],
+                data["altitude_gt"],
+            ]
+        )
+
+        gps_data = (gps_data * _GPS_SCALE).astype(np.int64)
+
+        # GPS data and groundtruth for the latitude, longitude and altitude
+        self._sensor_data.gps_data[:] = gps_data[: GPSField.NUM_FIELDS]
+        gps_groundtruth = gps_data[GPSField.NUM_FIELDS :].tolist()
+        self._sensor_data.sim_lat, self._sensor_data.sim_lon, self._sensor_data.sim_alt = gps_groundtruth
+
+        # GPS fix type and number of satellites
         self._sensor_data.fix_type = int(data["fix_type"])
-        self._sensor_data.latitude_deg = int(data["latitude"] * 10000000)
-        self._sensor_data.longitude_deg = int(data["longitude"] * 10000000)
-        self._sensor_data.altitude = int(data["altitude"] * 1000)
-        self._sensor_data.eph = int(data["eph"])
-        self._sensor_data.epv = int(data["epv"])
-        self._sensor_data.velocity = int(data["speed"] * 100)
-        self._sensor_data.velocity_north = int(data["velocity_north"] * 100)
-        self._sensor_data.velocity_east = int(data["velocity_east"] * 100)
-        self._sensor_data.velocity_down = int(data["velocity_down"] * 100)
-        self._sensor_data.cog = int(data["cog"] * 100)
         self._sensor_data.satellites_visible = int(data["sattelites_visible"])
 
         # Signal that we have new GPS data
         self._sensor_data.new_gps_data = True
 
-        # Also update the groundtruth for the latitude and longitude
-        self._sensor_data.sim_lat = int(data["latitude_gt"] * 10000000)
-        self._sensor_data.sim_lon = int(data["longitude_gt"] * 10000000)
-        self._sensor_data.sim_alt = int(data["altitude_gt"] * 1000)
-
     def update_bar_data(self, data):
         """Gets called by the 'update_sensor' method to update the current Barometer data
 
@@ -386,12 +471,12 @@ class MavlinkBackend(Backend):
         """
 
         # Barometer data
-        self._sensor_data.temperature = data["temperature"]
-        self._sensor_data.abs_pressure = data["absolute_pressure"]
-        self._sensor_data.pressure_alt = data["pressure_altitude"]
+        self._sensor_data.data[SensorField.TEMPERATURE] = data["temperature"]
+        self._sensor_data.data[SensorField.ABS_PRESSURE] = data["absolute_pressure"]
+        self._sensor_data.data[SensorField.PRESSURE_ALT] = data["pressure_altitude"]
 
         # Signal that we have new Barometer data
-        self._sensor_data.new_bar_data = True
+        self._sensor_data.new_data |= SensorMsg.NEW_BARO
 
     def update_mag_data(self, data):
         """Gets called by the 'update_sensor' method to update the current Vision data
@@ -401,12 +486,10 @@ class MavlinkBackend(Backend):
         """
 
         # Magnetometer data
-        self._sensor_data.xmag = data["magnetic_field"][0]
-        self._sensor_data.ymag = data["magnetic_field"][1]
-        self._sensor_data.zmag = data["magnetic_field"][2]
+        self._sensor_data.data[SensorField.MAG] = data["magnetic_field"]
 
         # Signal that we have new Magnetometer data
-        self._sensor_data.new_mag_data = True
+        self._sensor_data.new_data |= SensorMsg.NEW_MAG
 
     def update_vision_data(self, data):
         """Method that 'in the future' will get called by the 'update_sensor' method to update the current Vision data
@@ -439,29 +522,19 @@ class MavlinkBackend(Backend):
 
         # Rotate the quaternion to the mavlink standard
         self._sensor_data.sim_attitude[0] = attitude[3]
-        self._sensor_data.sim_attitude[1] = attitude[0]
-        self._sensor_data.sim_attitude[2] = attitude[1]
-        self._sensor_data.sim_attitude[3] = attitude[2]
+        self._sensor_data.sim_attitude[1:] = attitude[:3]
 
         # Get the angular velocity
-        ang_vel = state.get_angular_velocity_frd()
-        self._sensor_data.sim_angular_vel[0] = ang_vel[0]
-        self._sensor_data.sim_angular_vel[1] = ang_vel[1]
-        self._sensor_data.sim_angular_vel[2] = ang_vel[2]
+        self._sensor_data.sim_angular_vel[:] = state.get_angular_velocity_frd()
 
-        # Get the acceleration
-        acc_vel = state.get_linear_acceleration_ned()
-        self._sensor_data.sim_acceleration[0] = int(acc_vel[0] * 1000)
-        self._sensor_data.sim_acceleration[1] = int(acc_vel[1] * 1000)
-        self._sensor_data.sim_acceleration[2] = int(acc_vel[2] * 1000)
+        # Get the acceleration (the integer buffer truncates the values, in mG)
+        self._sensor_data.sim_acceleration[:] = state.get_linear_acceleration_ned() * 1000
 
         # Get the latitude, longitude and altitude directly from the GPS
 
         # Get the linear velocity of the vehicle in the inertial frame
         lin_vel = state.get_linear_velocity_ned()
-        self._sensor_data.sim_velocity_inertial[0] = int(lin_vel[0] * 100)
-        self._sensor_data.sim_velocity_inertial[1] = int(lin_vel[1] * 100)
-        self._sensor_data.sim_velocity_inertial[2] = int(lin_vel[2] * 100)
+        self._sensor_data.sim_velocity_inertial[:] = lin_vel * 100
 
         # Compute the air_speed - assumed indicated airspeed due to flow aligned with pitot (body x)
         body_vel = state.get_linear_body_velocity_ned_frd()
@@ -475,17 +548,25 @@ class MavlinkBackend(Backend):
         """
         return self._rotor_data.input_reference
 
-    def __del__(self):
-        """Gets called when the MavlinkBackend object gets destroyed. When this happens, we make sure
-        to close any mavlink connection open for this vehicle.
+    def close(self):
+        """Closes the mavlink connection open for this vehicle (if any), to free the communication port. This method
+        gets called when the simulation stops or, if it never stopped, when the python interpreter exits. It is safe
+        to call it more than once.
         """
 
-        # When this object gets destroyed, close the mavlink connection to free the communication port
+        # If the connection was never opened or was already closed, then ignore the function call
+        if self._connection is None:
+            return
+
         try:
             self._connection.close()
-            self._connection = None
-        except:
-            carb.log_info("Mavlink connection was not closed, because it was never opened")
+        except OSError:
+            carb.log_warn("Could not close the mavlink connection")
+
+        self._connection = None
+
+        # The connection no longer needs to be closed when the python interpreter exits
+        atexit.unregister(self.close)
 
     def start(self):
         """Method that handles the begining of the simulation of vehicle. It will try to open the mavlink connection 
@@ -503,6 +584,9 @@ class MavlinkBackend(Backend):
         # Set the flag to signal that the mavlink transmission has started
         self._is_running = True
 
+        # The first hearbeat is then checked at every update, without blocking the simulation
+        carb.log_warn("Waiting for first hearbeat")
+
         # Launch the PX4 in the background if needed
         if self.px4_autolaunch and self.px4_tool is None:
             carb.log_info("Attempting to launch PX4 in background process")
@@ -522,8 +606,7 @@ class MavlinkBackend(Backend):
         self._is_running = False
 
         # Close the mavlink connection
-        self._connection.close()
-        self._connection = None
+        self.close()
 
         # Close the PX4 if it was running
         if self.px4_autolaunch and self.px4_autolaunch is not None:
@@ -547,6 +630,12 @@ class MavlinkBackend(Backend):
 
         # Restart the connection
         self._connection = mavutil.mavlink_connection(self._connection_port)
+        self._recv_match = self._connection.recv_match
+
+        # Make sure the connection gets closed even if the simulation is never stopped (instead of relying on __del__,
+        # which is not guaranteed to run, or to run before the modules it needs are torn down, at the interpreter exit)
+        atexit.register(self.close)
+        self._tx_buffer.clear()
 
         # Auxiliar variables to handle the lockstep between receiving sensor data and actuator control
         self._received_first_actuator: bool = False
@@ -555,7 +644,11 @@ class MavlinkBackend(Backend):
         # Auxiliar variables to check if we have already received an hearbeat from the software in the loop simulation
         self._received_first_hearbeat: bool = False
 
-        self._last_heartbeat_sent_time = 0
+        # Precomputed HIL_SENSOR mavlink 2 header (only available after the first hearbeat is received)
+        self._hil_sensor_header: bytes = None
+        self._hil_sensor_crc_extra: bytes = None
+
+        self._next_heartbeat_time_ns: int = 0
 
     def wait_for_first_hearbeat(self):
         """
@@ -563,13 +656,52 @@ class MavlinkBackend(Backend):
         if an hearbeat is received via mavlink. When this first heartbeat is received poll for mavlink messages
         """
 
-        carb.log_warn("Waiting for first hearbeat")
         result = self._connection.wait_heartbeat(blocking=False)
 
         if result is not None:
             self._received_first_hearbeat = True
             carb.log_warn("Received first hearbeat")
 
+            # Only now the mavlink protocol version used by the connection is known (pymavlink switches to
+            # mavlink 2 when it receives the first mavlink 2 packet)
+            self.setup_hil_sensor_header()
+
+            # Cache the encode methods of the mavlink protocol object, which is only replaced on the protocol switch
+            self._heartbeat_encode = self._connection.mav.heartbeat_encode
+            self._hil_sensor_encode = self._connection.mav.hil_sensor_encode
+            self._hil_gps_encode = self._connection.mav.hil_gps_encode
+
+    def setup_hil_sensor_header(self):
+        """
+        Precomputes the fields of the HIL_SENSOR mavlink header that do not change between messages, such that
+        the sensor data can be serialized without going through the pymavlink message classes. This is only done
+        for unsigned mavlink 2 connections. Otherwise, the sensor data is still sent through pymavlink.
+        """
+
+        mav = self._connection.mav
+
+        # Note: check the protocol version of this connection, and not the one of the pymavlink module, which switches
+        # to mavlink 2 as soon as any connection (e.g. from another vehicle) receives a mavlink 2 packet
+        if self._connection.WIRE_PROTOCOL_VERSION != "2.0" or mav.signing.sign_outgoing:
+            self._hil_sensor_header = None
+            self._hil_sensor_crc_extra = None
+            return
+
+        # Header with the magic number, (length), incompat flags, compat flags, (sequence), system id, component id
+        # and message id. The length and sequence number are filled in for every message in 'pack_hil_sensor'
+        self._hil_sensor_header = _HIL_SENSOR_HEADER_STRUCT.pack(
+            253,
+            0,
+            0,
+            0,
+            0,
+            mav.srcSystem,
+            mav.srcComponent,
+            mavutil.mavlink.MAVLINK_MSG_ID_HIL_SENSOR & 0xFFFF,
+            mavutil.mavlink.MAVLINK_MSG_ID_HIL_SENSOR >> 16,
+        )
+        self._hil_sensor_crc_extra = bytes([mavutil.mavlink.MAVLink_hil_sensor_message.crc_extra])
+
     def update(self, dt):
         """
         Method that is called at every physics step to send data to px4 and receive the control inputs via mavlink
@@ -584,19 +716,31 @@ class MavlinkBackend(Backend):
             return
 
         # Check if we have already received IMU data. If not, start the lockstep and wait for more data
-        if self._sensor_data.received_first_imu:
-            while not self._sensor_data.new_imu_data and self._is_running:
-                # Just go for the next update and then try to check if we have new simulated sensor data
-                # DO not continue and get mavlink thrusters commands until we have simulated IMU data available
-                return
+        # Note: the sensors are updated by the same physics thread that calls this method, so blocking here would
+        # never let new IMU data arrive. Just go for the next update and then check again if we have new simulated
+        # sensor data. DO not continue and get mavlink thrusters commands until we have simulated IMU data available
+        if (
+            self._sensor_data.received_first_imu
+            and not self._sensor_data.new_data & SensorMsg.NEW_IMU
+            and self._is_running
+        ):
+            return
 
         # Check if we have received any mavlink messages
         self.poll_mavlink_messages()
 
-        # Send hearbeats at 1Hz
-        if (time.time() - self._last_heartbeat_sent_time) > 1.0 or self._received_first_hearbeat == False:
+        # Read the (monotonic) clock only once per update, in integer nanoseconds
+        now_ns: int = time.monotonic_ns()
+
+        # Send hearbeats at 1Hz, scheduled on absolute deadlines so that the rate does not drift
+        if now_ns >= self._next_heartbeat_time_ns:
             self.send_heartbeat()
-            self._last_heartbeat_sent_time = time.time()
+            self._next_heartbeat_time_ns += _HEARTBEAT_PERIOD_NS
+
+            # If we are more than one period behind (e.g. the simulation was paused), re-synchronize instead of
+            # catching up
+            if self._next_heartbeat_time_ns <= now_ns:
+                self._next_heartbeat_time_ns = now_ns + _HEARTBEAT_PERIOD_NS
 
         # Update the current u_time for px4
         self._current_utime += int(dt * 1000000)
@@ -607,13 +751,16 @@ class MavlinkBackend(Backend):
         # Send the GPS messages
         self.send_gps_msgs(self._current_utime)
 
+        # Write all the messages queued in this update to the connection at once
+        self.flush_messages()
+
     def poll_mavlink_messages(self):
         """
         Method that is used to check if new mavlink messages were received
         """
 
         # If we have not received the first hearbeat yet, do not poll for mavlink messages
-        if self._received_first_hearbeat == False:
+        if not self._received_first_hearbeat:
             return
 
         # Check if we need to lock and wait for actuator control data
@@ -622,14 +769,16 @@ class MavlinkBackend(Backend):
         # Start by assuming that we have not received data for the actuators for the current step
         self._received_actuator = False
 
+        # Instant after which we stop waiting for the actuator control data
+        wait_deadline: float = time.monotonic() + self._lockstep_timeout if needs_to_wait_for_actuator else 0.0
+
         # Use this loop to emulate a do-while loop (make sure this runs at least once)
         while True:
 
-            # Try to get a message
-            msg = self._connection.recv_match(blocking=needs_to_wait_for_actuator)
+            # Drain all the messages that were already received, without blocking
+            msg = self._recv_match(blocking=False)
 
-            # If a message was received
-            if msg is not None:
+            while msg is not None:
 
                 # Check if it is of the type that contains actuator controls
                 if msg.id == mavutil.mavlink.MAVLINK_MSG_ID_HIL_ACTUATOR_CONTROLS:
@@ -640,86 +789,135 @@ class MavlinkBackend(Backend):
                     # Handle the control of the actuation commands received by PX4
                     self.handle_control(msg.time_usec, msg.controls, msg.mode, msg.flags)
 
+                msg = self._recv_match(blocking=False)
+
             # Check if we do not need to wait for an actuator message or we just received actuator input
             # If so, break out of the infinite loop
             if not needs_to_wait_for_actuator or self._received_actuator:
                 break
 
+            # If PX4 stopped responding (e.g. it was killed), do not hang the simulation waiting forever. Only resume
+            # the lockstep once a new actuator control message is received
+            if time.monotonic() > wait_deadline:
+                carb.log_warn(
+                    "Did not receive actuator controls through mavlink, waiting for PX4 to resume the lockstep"
+                )
+                self._received_first_actuator = False
+                break
+
+            # Otherwise, sleep on the connection file descriptor until more data arrives
+            self._connection.select(self._time_step)
+
+    def queue_message(self, msg):
+        """
+        Method that serializes a pymavlink message and queues it to be written to the connection by 'flush_messages'.
+        The pymavlink packet counters are updated as if the message was sent through the corresponding '*_send' method
+
+        Args:
+            msg (MAVLink_message): The mavlink message to send
+        """
+
+        mav = self._connection.mav
+        frame = msg.pack(mav)
+        self._tx_buffer += frame
+
+        mav.seq = (mav.seq + 1) % 256
+        mav.total_packets_sent += 1
+        mav.total_bytes_sent += len(frame)
+
+    def flush_messages(self):
+        """
+        Method that writes all the mavlink frames queued since the last call to the connection, in a single write
+        """
+
+        if not self._tx_buffer:
+            return
+
+        try:
+            self._connection.write(self._tx_buffer)
+        except OSError:
+            carb.log_warn("Could not send data through mavlink")
+
+        self._tx_buffer.clear()
+
     def send_heartbeat(self, mav_type=mavutil.mavlink.MAV_TYPE_GENERIC):
         """
-        Method that is used to publish an heartbear through mavlink protocol
+        Method that is used to queue an heartbear to publish through mavlink protocol
 
         Args: 
             mav_type (int): The ID that indicates the type of vehicle. Defaults to MAV_TYPE_GENERIC=0 
         """
 
-        carb.log_info("Sending heartbeat")
-
         # Note: to know more about these functions, go to pymavlink->dialects->v20->standard.py
         # This contains the definitions for sending the hearbeat and simulated sensor messages
-        self._connection.mav.heartbeat_send(mav_type, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
+        self.queue_message(self._heartbeat_encode(mav_type, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0))
 
     def send_sensor_msgs(self, time_usec: int):
         """
-        Method that when invoked, will send the simulated sensor data through mavlink
+        Method that when invoked, will queue the simulated sensor data to send through mavlink
 
         Args:
             time_usec (int): The total time elapsed since the simulation started
         """
-        carb.log_info("Sending sensor msgs")
 
-        # Check which sensors have new data to send
-        fields_updated: int = 0
+        # Check which sensors have new data to send and set the bit field of each one of them accordingly
+        fields_updated: int = _FIELDS_UPDATED_LUT[self._sensor_data.new_data]
+        self._sensor_data.new_data = 0
 
-        if self._sensor_data.new_imu_data:
-            # Set the bit field to signal that we are sending updated accelerometer and gyro data
-            fields_updated = fields_updated | SensorSource.ACCEL | SensorSource.GYRO
-            self._sensor_data.new_imu_data = False
+        # Do not send sensor data, if no sensor produced new data
+        if fields_updated == 0:
+            return
 
-        if self._sensor_data.new_mag_data:
-            # Set the bit field to signal that we are sending updated magnetometer data
-            fields_updated = fields_updated | SensorSource.MAG
-            self._sensor_data.new_mag_data = False
+        if self._hil_sensor_header is not None:
+            self._tx_buffer += self.pack_hil_sensor(time_usec, fields_updated)
+        else:
+            # The sensor buffer is stored in the same order as the HIL_SENSOR fields, so unpack it all at once
+            self.queue_message(self._hil_sensor_encode(time_usec, *self._sensor_data.data.tolist(), fields_updated))
 
-        if self._sensor_data.new_bar_data:
-            # Set the bit field to signal that we are sending updated barometer data
-            fields_updated = fields_updated | SensorSource.BARO
-            self._sensor_data.new_bar_data = False
+    def pack_hil_sensor(self, time_usec: int, fields_updated: int) -> bytearray:
+        """
+        Method that serializes the simulated sensor data into an HIL_SENSOR mavlink 2 frame, using the header
+        precomputed in 'setup_hil_sensor_header'. The frame is byte for byte the one pymavlink would send, and the
+        pymavlink packet counters are updated as if it was sent through 'hil_sensor_send'
 
-        if self._sensor_data.new_press_data:
-            # Set the bit field to signal that we are sending updated diff pressure data
-            fields_updated = fields_updated | SensorSource.DIFF_PRESS
-            self._sensor_data.new_press_data = False
+        Args:
+            time_usec (int): The total time elapsed since the simulation started
+            fields_updated (int): The bitmask with the sensors that have new data
 
-        try:
-            self._connection.mav.hil_sensor_send(
-                time_usec,
-                self._sensor_data.xacc,
-                self._sensor_data.yacc,
-                self._sensor_data.zacc,
-                self._sensor_data.xgyro,
-                self._sensor_data.ygyro,
-                self._sensor_data.zgyro,
-                self._sensor_data.xmag,
-                self._sensor_data.ymag,
-                self._sensor_data.zmag,
-                self._sensor_data.abs_pressure,
-                self._sensor_data.diff_pressure,
-                self._sensor_data.pressure_alt,
-                self._sensor_data.altitude,
-                fields_updated,
-            )
-        except:
-            carb.log_warn("Could not send sensor data through mavlink")
+        Returns:
+            bytearray: The serialized HIL_SENSOR frame
+        """
+
+        mav = self._connection.mav
+
+        # Mavlink 2 truncates the trailing zeros of the payload (but always keeps at least one byte)
+        payload = _HIL_SENSOR_PAYLOAD_STRUCT.pack(time_usec, *self._sensor_data.data.tolist(), fields_updated)
+        payload = payload.rstrip(b"\x00") or payload[:1]
+
+        # Fill in the length and sequence number of the precomputed header
+        frame = bytearray(self._hil_sensor_header)
+        frame[1] = len(payload)
+        frame[4] = mav.seq
+        frame += payload
+
+        # The checksum covers everything but the magic number, plus the crc extra of the message
+        crc = mavutil.mavlink.x25crc(frame[1:])
+        crc.accumulate(self._hil_sensor_crc_extra)
+        frame += _CRC_STRUCT.pack(crc.crc)
+
+        mav.seq = (mav.seq + 1) % 256
+        mav.total_packets_sent += 1
+        mav.total_bytes_sent += len(frame)
+
+        return frame
 
     def send_gps_msgs(self, time_usec: int):
         """
-        Method that is used to send simulated GPS data through the mavlink protocol.
+        Method that is used to queue simulated GPS data to send through the mavlink protocol.
 
         Args:
             time_usec (int): The total time elapsed since the simulation started
         """
-        carb.log_info("Sending GPS msgs")
 
         # Do not send GPS data, if no new data was received
         if not self._sensor_data.new_gps_data:
@@ -728,24 +926,15 @@ class MavlinkBackend(Backend):
         self._sensor_data.new_gps_data = False
 
         # Latitude, longitude and altitude (all in integers)
-        try:
-            self._connection.mav.hil_gps_send(
+        # The GPS buffer is stored in the same order as the HIL_GPS fields, so unpack it all at once
+        self.queue_message(
+            self._hil_gps_encode(
                 time_usec,
                 self._sensor_data.fix_type,
-                self._sensor_data.latitude_deg,
-                self._sensor_data.longitude_deg,
-                self._sensor_data.altitude,
-                self._sensor_data.eph,
-                self._sensor_data.epv,
-                self._sensor_data.velocity,
-                self._sensor_data.velocity_north,
-                self._sensor_data.velocity_east,
-                self._sensor_data.velocity_down,
-                self._sensor_data.cog,
+                *self._sensor_data.gps_data.tolist(),
                 self._sensor_data.satellites_visible,
             )
-        except:
-            carb.log_warn("Could not send gps data through mavlink")
+        )
 
     def send_vision_msgs(self, time_usec: int):
         """
@@ -754,7 +943,6 @@ class MavlinkBackend(Backend):
         Args:
             time_usec (int): The total time elapsed since the simulation started
         """
-        carb.log_info("Sending vision/mocap msgs")
 
         # Do not send vision/mocap data, if not new data was received
         if not self._sensor_data.new_vision_data:
@@ -773,7 +961,7 @@ class MavlinkBackend(Backend):
                 self._sensor_data.vision_yaw,
                 self._sensor_data.vision_covariance,
             )
-        except:
+        except OSError:
             carb.log_warn("Could not send vision/mocap data through mavlink")
 
     def send_ground_truth(self, time_usec: int):
@@ -784,8 +972,6 @@ class MavlinkBackend(Backend):
             time_usec (int): The total time elapsed since the simulation started
         """
 
-        carb.log_info("Sending groundtruth msgs")
-
         # Do not send vision/mocap data, if not new data was received
         if not self._sensor_data.new_sim_state or self._sensor_data.sim_alt == 0:
             return
@@ -795,23 +981,17 @@ class MavlinkBackend(Backend):
         try:
             self._connection.mav.hil_state_quaternion_send(
                 time_usec,
-                self._sensor_data.sim_attitude,
-                self._sensor_data.sim_angular_vel[0],
-                self._sensor_data.sim_angular_vel[1],
-                self._sensor_data.sim_angular_vel[2],
+                self._sensor_data.sim_attitude.tolist(),
+                *self._sensor_data.sim_angular_vel.tolist(),
                 self._sensor_data.sim_lat,
                 self._sensor_data.sim_lon,
                 self._sensor_data.sim_alt,
-                self._sensor_data.sim_velocity_inertial[0],
-                self._sensor_data.sim_velocity_inertial[1],
-                self._sensor_data.sim_velocity_inertial[2],
+                *self._sensor_data.sim_velocity_inertial.tolist(),
                 self._sensor_data.sim_ind_airspeed,
                 self._sensor_data.sim_true_airspeed,
-                self._sensor_data.sim_acceleration[0],
-                self._sensor_data.sim_acceleration[1],
-                self._sensor_data.sim_acceleration[2],
+                *self._sensor_data.sim_acceleration.tolist(),
             )
-        except:
+        except OSError:
             carb.log_warn("Could not send groundtruth through mavlink")
 
     def handle_control(self, time_usec, controls, mode, flags):
@@ -829,8 +1009,6 @@ class MavlinkBackend(Backend):
         # pymavlink is return 129 (the end of the buffer)
         if mode == mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED + 1:
 
-            carb.log_info("Parsing control input")
-
             # Set the rotor target speeds
             self._rotor_data.update_input_reference(controls)
 